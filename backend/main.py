@@ -1,26 +1,33 @@
 import os
 import re
-import json
+import orjson
 import logging
 import shutil
 import asyncio
 import hashlib
+import time
+import uuid
+from abc import ABC, abstractmethod
 from contextlib import asynccontextmanager
+from collections.abc import Iterator
+from functools import lru_cache
+from typing import NamedTuple
 
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel, HttpUrl
 from dotenv import load_dotenv
 from starlette.websockets import WebSocketState
 from fastapi.staticfiles import StaticFiles
 
 from .mcp_client import MCPClient
-from anthropic import Anthropic, APIError
-from bs4 import BeautifulSoup
+from anthropic import AsyncAnthropic, APIError
+from selectolax.lexbor import LexborHTMLParser
 import httpx
+import aiofiles
 from PIL import Image, ImageDraw, ImageFont
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlsplit
 
 # ─── Logging & env ──────────────────────────────────────────────────────────
 logging.basicConfig(level=logging.INFO)
@@ -29,6 +36,30 @@ load_dotenv()
 
 # ─── Constants ─────────────────────────────────────────────────────────────
 CLONED_PROJECT_DIR = "cloned_project"
+# Downloaded assets persist here across clone runs, keyed by URL hash
+ASSET_CACHE_DIR = os.path.expanduser(os.getenv("ASSET_CACHE_DIR", "~/.cache/orchids/assets"))
+# Seconds a cached asset is used without asking the origin whether it changed
+ASSET_CACHE_MAX_AGE = int(os.getenv("ASSET_CACHE_MAX_AGE", 24 * 60 * 60))
+ASSET_FETCH_CONCURRENCY = 8  # max simultaneous asset downloads
+ASSET_CHUNK_SIZE = 64 * 1024 # bytes per streamed write
+AI_TOKEN_BATCH_SIZE = 32     # tokens coalesced into one "ai_tokens" event
+AI_TOKEN_FLUSH_INTERVAL = 0.015  # seconds a partial token batch may wait
+SSE_QUEUE_MAXSIZE = 256      # SSE frames buffered for a client before writers wait
+DOM_SUMMARY_CONCURRENCY = 4  # Haiku chunk summaries in flight at once
+FILES_TREE_CACHE_TTL = 2.0   # seconds a /files/tree listing is reused at most
+
+# enhanced_page_analyzer keys whose values hold image/icon URLs
+ANALYSIS_ASSET_KEYS = frozenset({"images", "icons", "assets"})
+# Keys of an analyzer asset entry that hold its URL
+ANALYSIS_URL_KEYS = ("src", "url", "href")
+# An analyzer URL with a file extension must have one of these to count as an image/icon
+IMAGE_EXTENSIONS = frozenset({".png", ".jpg", ".jpeg", ".gif", ".webp", ".avif", ".svg", ".ico", ".bmp"})
+
+# Script tag boundaries for strip_scripts' single left-to-right pass
+_SCRIPT_OPEN_RE = re.compile(r"<script\b", re.IGNORECASE)
+_SCRIPT_CLOSE_RE = re.compile(r"</script\s*>", re.IGNORECASE)
+_WHITESPACE_RE = re.compile(r"\s+")
+_HTML_FENCE_RE = re.compile(r"```html\n(.*?)\n```", re.DOTALL)
 
 PRE_SUMMARY_SYSTEM_PROMPT = (
     "Summarise the layout & styling cues of this fragment in <120 words>. "
@@ -40,11 +71,11 @@ PRE_SUMMARY_SYSTEM_PROMPT = (
 ANALYSIS_SYSTEM_PROMPT = """
 You are Vision-Sonnet acting as a senior UI/UX analyst.
 You receive a JSON payload called `designContext` with every fact our
-scraper & AI-Vision tools could extract from the target URL, e.g.
+scraper & AI-Vision tools could extract from the target URL (the full-page
+screenshot, when available, is attached as an image), e.g.
 
 {
   "pageUrl": "...",
-  "viewportScreenshot": "<base64-png>",
   "domTree": "... raw outerHTML OR pre-summaries ...",
   "computedStyles": { "...": "..." },
   "layoutTree": [...],
@@ -110,12 +141,105 @@ Ensure your output is only the raw HTML code. Do not include any explanations, c
 """
 
 # ─── Utility helpers ────────────────────────────────────────────────────────
-def write_file(path: str, content: str):
+async def write_file(path: str, content: str):
     os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(content)
+    async with aiofiles.open(path, "w", encoding="utf-8") as f:
+        await f.write(content)
     logger.info("Wrote %s", path)
 
+@lru_cache(maxsize=4096)
+def _short_hash(url: str) -> str:
+    """10-hex-char filename hash for an asset URL (BLAKE2b, 5-byte digest)."""
+    return hashlib.blake2b(url.encode("utf-8"), digest_size=5).hexdigest()
+
+def scan_tree(root: str) -> tuple[list[str], dict[str, int]]:
+    """Relative file paths under `root` (top-down) and the mtime of every directory visited."""
+    files, dir_mtimes = [], {}
+
+    def _walk(path: str, rel: str):
+        dir_mtimes[path] = os.stat(path).st_mtime_ns
+        subdirs = []
+        with os.scandir(path) as it:
+            for entry in it:
+                entry_rel = os.path.join(rel, entry.name) if rel else entry.name
+                if entry.is_dir():
+                    # Like os.walk: a symlinked directory is not a file, but is not descended into
+                    if not entry.is_symlink():
+                        subdirs.append((entry.path, entry_rel))
+                else:
+                    files.append(entry_rel)
+        for sub_path, sub_rel in subdirs:
+            _walk(sub_path, sub_rel)
+
+    _walk(root, "")
+    return files, dir_mtimes
+
+def dirs_unchanged(dir_mtimes: dict[str, int]) -> bool:
+    """True if every directory from `scan_tree` still exists with the same mtime."""
+    try:
+        return all(os.stat(d).st_mtime_ns == m for d, m in dir_mtimes.items())
+    except FileNotFoundError:
+        return False
+
+def strip_html_fence(text: str) -> str:
+    """Removes a ```html ... ``` markdown fence the model may wrap its answer in."""
+    s = text.strip()
+    if s.startswith("```html"):
+        # Common case: the whole answer is one fenced block, possibly followed by chatter
+        # that may itself mention fences, so cut at the first closing-fence line
+        s = s[len("```html"):]
+        end = s.find("\n```")
+        if end != -1:
+            s = s[:end]
+        elif s.endswith("```"): # ```html<p>x</p>``` on one line
+            s = s[:-3]
+        return s.strip()
+    if "```html" in s:
+        return _HTML_FENCE_RE.sub(r"\1", s).strip()
+    return s
+
+def strip_scripts(html: str) -> str:
+    """Drops every <script> element in one pass; an unclosed one takes the rest of the string with it.
+
+    Each character is scanned at most once, so runs of unclosed tags stay linear.
+    """
+    out, pos = [], 0
+    while (opener := _SCRIPT_OPEN_RE.search(html, pos)) is not None:
+        out.append(html[pos:opener.start()])
+        tag_end = html.find(">", opener.end())
+        closer = _SCRIPT_CLOSE_RE.search(html, tag_end + 1) if tag_end != -1 else None
+        if closer is None:
+            return "".join(out)
+        pos = closer.end()
+    out.append(html[pos:])
+    return "".join(out)
+
+def is_asset_url(url: str) -> bool:
+    """True for an http(s) or relative URL that points at something other than the page itself."""
+    if not url or url.startswith("#") or any(c.isspace() for c in url):
+        return False
+    parts = urlsplit(url)
+    return parts.scheme in ("", "http", "https") and parts.path not in ("", "/")
+
+def link_or_copy(src: str, dst: str):
+    """Hard-links `src` to `dst`, copying instead when linking is not possible."""
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError: # cross-device, or no hard-link support
+        shutil.copyfile(src, dst)
+
+def screenshot_image_block(item) -> dict | None:
+    """Anthropic image block for an MCP image result, or None if `item` is not an image."""
+    data = getattr(item, "data", None)
+    if getattr(item, "type", None) != "image" or not isinstance(data, str):
+        return None
+    return {
+        "type": "image",
+        "source": {"type": "base64", "media_type": getattr(item, "mimeType", None) or "image/png", "data": data},
+    }
+
 def json_default_serializer(obj):
     if hasattr(obj, "model_dump"):
         return obj.model_dump()
@@ -123,19 +247,61 @@ def json_default_serializer(obj):
         return obj.to_dict()
     return str(obj)
 
-# ─── WebSocket notifier ─────────────────────────────────────────────────────
-class WebSocketEventNotifier:
-    def __init__(self, ws: WebSocket):
-        self.ws = ws
+# ─── Event notifiers ────────────────────────────────────────────────────────
+class EventNotifier(ABC):
+    """Clone/modify progress events; subclasses only decide how a frame is written."""
+    def __init__(self):
+        self._tokens: list[str] = []
+        self._flush_task: asyncio.Task | None = None
+        # Serialises writes from the timed flush and the caller
+        self._write_lock = asyncio.Lock()
+
+    @abstractmethod
+    async def _write(self, event: str, data: dict):
+        """Delivers one event to the client."""
+
+    @abstractmethod
+    async def close(self):
+        """Flushes pending tokens and ends the stream."""
+
+    async def _write_pending_tokens(self):
+        if self._tokens:
+            tokens, self._tokens = self._tokens, []
+            await self._write("ai_tokens", {"tokens": tokens})
 
     async def _send(self, event: str, data: dict):
-        await self.ws.send_json({"event": event, "data": data})
+        async with self._write_lock:
+            # Pending tokens go out first so clients see events in order
+            await self._write_pending_tokens()
+            await self._write(event, data)
+
+    async def flush_tokens(self):
+        async with self._write_lock:
+            await self._write_pending_tokens()
+
+    async def _flush_after_interval(self):
+        await asyncio.sleep(AI_TOKEN_FLUSH_INTERVAL)
+        try:
+            await self.flush_tokens()
+        except (WebSocketDisconnect, RuntimeError) as e:
+            # Nobody awaits this task, so a send on a closed socket must not escape
+            logger.debug("Dropped timed token flush: %s", e)
+
+    def cancel_flush(self):
+        """Stops a pending timed token flush, e.g. once the client has gone away."""
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
 
     async def log(self, msg: str):
         await self._send("log", {"message": msg})
 
     async def ai_token(self, tok: str):
-        await self._send("ai_token", {"token": tok})
+        # Coalesce tokens into one frame per interval (or full batch) instead of one per token
+        self._tokens.append(tok)
+        if len(self._tokens) >= AI_TOKEN_BATCH_SIZE:
+            await self.flush_tokens()
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_after_interval())
 
     async def file_event(self, typ: str, path: str, content: str = "", old: str = ""):
         await self._send(typ, {"path": path, "content": content, "old_content": old})
@@ -143,9 +309,57 @@ class WebSocketEventNotifier:
     async def status_update(self, status: str):
         await self._send("status", {"status": status})
 
+class WebSocketEventNotifier(EventNotifier):
+    """Sends each event as a JSON text frame on the WebSocket."""
+    def __init__(self, ws: WebSocket):
+        super().__init__()
+        self.ws = ws
+
+    async def _write(self, event: str, data: dict):
+        await self.ws.send_text(orjson.dumps({"event": event, "data": data}).decode())
+
     async def close(self):
+        self.cancel_flush()
+        await self.flush_tokens()
         await self.ws.close()
 
+class SSEEventNotifier(EventNotifier):
+    """Queues each event as a Server-Sent Event frame for `events()` to stream out."""
+    def __init__(self):
+        super().__init__()
+        # Bounded so a slow client applies backpressure instead of buffering the whole run
+        self.queue: asyncio.Queue[str | None] = asyncio.Queue(maxsize=SSE_QUEUE_MAXSIZE)
+        self._detached = False
+
+    async def _write(self, event: str, data: dict):
+        if not self._detached:
+            await self.queue.put(f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n")
+
+    def detach(self):
+        """Called once the client is gone: nothing reads the queue any more, so stop writing to it."""
+        self._detached = True
+        self.cancel_flush()
+
+    async def close(self):
+        self.cancel_flush()
+        if self._detached:
+            return
+        await self.flush_tokens()
+        await self.queue.put(None)
+
+    async def events(self):
+        while (frame := await self.queue.get()) is not None:
+            yield frame
+
+# ─── Files tree cache ───────────────────────────────────────────────────────
+class FilesTreeListing(NamedTuple):
+    """One /files/tree walk, kept until a directory changes or it expires."""
+    root: str
+    dir_mtimes: dict[str, int]
+    files: list[str]
+    etag: str
+    scanned_at: float # time.monotonic() when the walk started
+
 # ─── Pydantic model ─────────────────────────────────────────────────────────
 class CloneUrlRequest(BaseModel):
     url: HttpUrl
@@ -156,186 +370,407 @@ class AppState:
         api_key = os.getenv("ANTHROPIC_API_KEY")
         if not api_key:
             raise ValueError("ANTHROPIC_API_KEY env var is missing.")
-        self.llm = Anthropic(api_key=api_key)
+        self.llm = AsyncAnthropic(api_key=api_key)
         self.mcp_client = MCPClient()
+        # One pooled client for every asset download; closed on app shutdown
+        self.http = httpx.AsyncClient(
+            http2=True,
+            follow_redirects=True,
+            timeout=httpx.Timeout(10.0),
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=30),
+        )
+        # Placeholder font and canvas are built once and reused per image
+        try:
+            self._placeholder_font = ImageFont.truetype("arial.ttf", 40)
+        except IOError:
+            self._placeholder_font = ImageFont.load_default()
+        self._placeholder_base = Image.new('RGB', (800, 600), color = 'grey')
+        # The last /files/tree walk
+        self._files_tree_cache: FilesTreeListing | None = None
+
+    # --- UI preview helpers ---
+    def list_project_files(self) -> tuple[list[str], str]:
+        """Files in CLONED_PROJECT_DIR plus an ETag; the last walk is reused until a directory changes.
+
+        Filesystems with coarse timestamps can add a file without moving a directory
+        mtime, so a listing is also rescanned once it is FILES_TREE_CACHE_TTL old.
+        """
+        cached = self._files_tree_cache
+        if (cached and cached.root == CLONED_PROJECT_DIR
+                and time.monotonic() - cached.scanned_at < FILES_TREE_CACHE_TTL and dirs_unchanged(cached.dir_mtimes)):
+            return cached.files, cached.etag
+
+        scanned_at = time.monotonic()
+        try:
+            files, dir_mtimes = scan_tree(CLONED_PROJECT_DIR)
+        except FileNotFoundError:
+            self._files_tree_cache = None
+            return [], ""
+
+        # The file list is part of the ETag so a rescan with equal mtimes still changes it
+        signature = repr((sorted(dir_mtimes.items()), files)).encode()
+        etag = f'"{hashlib.blake2b(signature, digest_size=8).hexdigest()}"'
+        self._files_tree_cache = FilesTreeListing(CLONED_PROJECT_DIR, dir_mtimes, files, etag, scanned_at)
+        return files, etag
 
     # --- token/char helper (rough) ---
-    def _split_into_chunks(self, text: str, size: int) -> list[str]:
-        return [text[i:i + size] for i in range(0, len(text), size)]
+    def _split_into_chunks(self, text: str, size: int) -> Iterator[str]:
+        # Lazy so only the chunks being summarised are alive at once
+        for i in range(0, len(text), size):
+            yield text[i:i + size]
 
     # --- security ---
     def _sanitize_html(self, html: str) -> str:
-        return re.sub(r"<script\b[^<]*(?:(?!<\/script>)<[^<]*)*<\/script>",
-                      "", html, flags=re.IGNORECASE | re.DOTALL)
+        return strip_scripts(html)
 
     # --- Asset Pipeline Helpers ---
     def _create_placeholder_image(self, file_path: str, size: tuple[int, int] = (800, 600)):
-        """Creates a gray placeholder image with text."""
+        """Creates a gray placeholder image with text. Blocking; call via asyncio.to_thread."""
         try:
-            img = Image.new('RGB', size, color = 'grey')
+            if size == self._placeholder_base.size:
+                img = self._placeholder_base.copy()
+            else:
+                img = Image.new('RGB', size, color = 'grey')
             d = ImageDraw.Draw(img)
-            try:
-                font = ImageFont.truetype("arial.ttf", 40)
-            except IOError:
-                font = ImageFont.load_default()
             
             text = os.path.basename(file_path)
-            d.text((10,10), f"Placeholder for\n{text}", fill='white', font=font)
+            d.text((10,10), f"Placeholder for\n{text}", fill='white', font=self._placeholder_font)
             img.save(file_path)
             logger.info("Created placeholder for %s", file_path)
         except Exception as e:
             logger.error("Failed to create placeholder image %s: %s", file_path, e)
 
-    async def _prefetch_assets(self, html_content: str, page_url: str, notif: WebSocketEventNotifier) -> dict[str, str]:
-        """Finds all images/icons, downloads them, and returns a map of remote_url -> local_path."""
-        await notif.log("Starting asset prefetch process...")
-        logger.info("Starting asset prefetch for URL: %s", page_url)
-        
-        soup = BeautifulSoup(html_content, 'lxml')
+    async def _fetch_to_file(self, url: str, path: str, etag: str | None = None) -> httpx.Response:
+        """Streams `url` into `path` through a temp file and returns the response.
+
+        With `etag`, the request is conditional and a 304 leaves `path` untouched.
+        """
+        # Unique temp name so concurrent fetches of one URL never share a file
+        tmp_path = f"{path}.{uuid.uuid4().hex}.part"
+        try:
+            async with self.http.stream("GET", url, headers={"If-None-Match": etag} if etag else None) as response:
+                if etag and response.status_code == 304:
+                    return response
+                response.raise_for_status()
+
+                async with aiofiles.open(tmp_path, 'wb') as f:
+                    async for chunk in response.aiter_bytes(ASSET_CHUNK_SIZE):
+                        await f.write(chunk)
+            os.replace(tmp_path, path)
+            return response
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    async def _refresh_cached_asset(self, url: str, cache_path: str):
+        """Makes sure `cache_path` holds a copy of `url` no older than ASSET_CACHE_MAX_AGE.
+
+        A stale copy is revalidated with its stored ETag before being downloaded again.
+        """
+        etag_path = f"{cache_path}.etag"
+        if os.path.exists(cache_path):
+            if time.time() - os.path.getmtime(cache_path) < ASSET_CACHE_MAX_AGE:
+                logger.info("Asset cache hit: %s", url)
+                return
+            etag = None
+            if os.path.exists(etag_path):
+                with open(etag_path, encoding="utf-8") as f:
+                    etag = f.read().strip() or None
+        else:
+            os.makedirs(ASSET_CACHE_DIR, exist_ok=True)
+            etag = None
+
+        response = await self._fetch_to_file(url, cache_path, etag)
+        if response.status_code == 304:
+            logger.info("Asset cache revalidated: %s", url)
+            os.utime(cache_path) # fresh for another ASSET_CACHE_MAX_AGE
+        elif new_etag := response.headers.get("etag"):
+            with open(etag_path, "w", encoding="utf-8") as f:
+                f.write(new_etag)
+        elif os.path.exists(etag_path):
+            os.remove(etag_path)
+
+    async def _download_asset(self, url: str, local_path: str):
+        """Places a single asset at `local_path`, from the on-disk cache when possible.
+
+        Cache misses are streamed into ASSET_CACHE_DIR first; if the cache cannot be
+        used, the asset is downloaded straight to `local_path`. Raises on network/HTTP errors.
+        """
+        # Full-width digest: this store outlives a run and is shared by every site,
+        # and a name collision would serve the wrong file with no way to notice
+        cache_path = os.path.join(ASSET_CACHE_DIR, hashlib.blake2b(url.encode("utf-8"), digest_size=16).hexdigest())
+        try:
+            await self._refresh_cached_asset(url, cache_path)
+        except OSError as e: # read-only home, a file in the way, disk full...
+            logger.warning("Asset cache unusable (%s); downloading %s directly", e, url)
+            await self._fetch_to_file(url, local_path)
+            return
+
+        await asyncio.to_thread(link_or_copy, cache_path, local_path)
+
+    def _extract_asset_urls(self, analysis, dom_html: str) -> list[str]:
+        """Image/icon URLs from the page analyzer output; the DOM is parsed only if it lists no images."""
+        payload = getattr(analysis, "text", analysis)
+        if isinstance(payload, (str, bytes)):
+            try:
+                payload = orjson.loads(payload)
+            except orjson.JSONDecodeError:
+                payload = None
+
+        image_urls, icon_urls = [], []
+
+        def _accept(value: str, bare: bool) -> bool:
+            if not is_asset_url(value):
+                return False
+            parts = urlsplit(value)
+            ext = os.path.splitext(parts.path)[1].lower()
+            if ext: # rules out stylesheets, scripts and words such as "Node.js"
+                return ext in IMAGE_EXTENSIONS
+            # A bare word ("Hero", "1200") is metadata unless it is clearly a path or absolute URL
+            return not bare or bool(parts.netloc) or value.startswith(("/", "./", "../"))
+
+        def _collect(value, urls: list[str]):
+            if isinstance(value, str):
+                if _accept(value, bare=True):
+                    urls.append(value)
+            elif isinstance(value, list):
+                for item in value:
+                    _collect(item, urls)
+            elif isinstance(value, dict):
+                ref = next((value[k] for k in ANALYSIS_URL_KEYS if isinstance(value.get(k), str)), None)
+                if ref is not None:
+                    if _accept(ref, bare=False):
+                        urls.append(ref)
+                else: # Other string fields are metadata; only nested entries can hold URLs
+                    for item in value.values():
+                        if isinstance(item, (list, dict)):
+                            _collect(item, urls)
+
+        def _walk(node):
+            if isinstance(node, dict):
+                for key, value in node.items():
+                    if key in ANALYSIS_ASSET_KEYS:
+                        _collect(value, icon_urls if key == "icons" else image_urls)
+                    else:
+                        _walk(value)
+            elif isinstance(node, list):
+                for item in node:
+                    _walk(item)
+
+        _walk(payload)
+        if image_urls:
+            # The analyzer inventoried the page's images, so the DOM need not be parsed
+            return image_urls + icon_urls
+
+        # Fallback (e.g. the analyzer only reported the favicon): find images in
+        # <img> tags and <link rel="icon"> tags
+        tree = LexborHTMLParser(dom_html)
+        dom_urls = [img.attributes.get('src') for img in tree.css('img[src]')]
+        dom_urls += [link.attributes.get('href') for link in tree.css('link[href]')
+                     if 'icon' in (link.attributes.get('rel') or '').lower()]
+        return icon_urls + [url for url in dom_urls if is_asset_url(url)]
+
+    def _plan_assets(self, urls: list[str], page_url: str) -> tuple[dict[str, tuple[str, str]], dict[str, str]]:
+        """Assigns each image/icon a local file without downloading anything.
+
+        Returns the download plan (abs_src -> (local_path, local_preview_path))
+        and the remote_url -> local_preview_path map for the design context.
+        """
         asset_dir = os.path.join(CLONED_PROJECT_DIR, "assets")
-        os.makedirs(asset_dir, exist_ok=True)
-        
+        urls_to_fetch = list(dict.fromkeys(urls)) # Drop exact repeats, keep order
+
+        # Normalise once and dedupe on the absolute URL, so aliases such as
+        # "logo.png" and "/logo.png" share one download
+        plan: dict[str, tuple[str, str]] = {}
         asset_map = {}
-        # Find images in <img> tags and <link rel="icon"> tags
-        urls_to_fetch = [img['src'] for img in soup.find_all('img') if img.get('src')]
-        urls_to_fetch += [link['href'] for link in soup.find_all('link', rel=re.compile(r'icon', re.I)) if link.get('href')]
+        for url in urls_to_fetch:
+            if not url:
+                continue
+
+            # Resolve relative URLs to absolute URLs
+            abs_src = urljoin(page_url, url)
+            if urlsplit(abs_src).scheme not in ("http", "https"): # data:, mailto:, javascript: ...
+                continue
+            if abs_src in plan: # Already queued under another spelling
+                asset_map[url] = plan[abs_src][1]
+                continue
+            
+            # Create a sanitized, unique filename
+            try:
+                ext = os.path.splitext(abs_src.split('?')[0])[1] or '.png' # Default extension
+                filename_hash = _short_hash(abs_src)
+                filename = f"{filename_hash}{ext}"
+                local_path = os.path.join(asset_dir, filename)
+                # Path for the browser to use in the <img src="...">
+                local_preview_path = f"/preview/assets/{filename}"
+            except Exception as e:
+                logger.warning("Skipping invalid asset URL: %s (%s)", url, e)
+                continue
 
-        await notif.log(f"Found {len(set(urls_to_fetch))} unique assets to process...")
-        logger.info("Found %d unique assets to process", len(set(urls_to_fetch)))
+            plan[abs_src] = (local_path, local_preview_path)
+            asset_map[abs_src] = local_preview_path
+            asset_map[url] = local_preview_path # Also map original URL
 
-        async with httpx.AsyncClient() as client:
-            for url in set(urls_to_fetch): # Use set to avoid duplicate downloads
-                if not url or url.startswith('data:'):
-                    continue
+        return plan, asset_map
 
-                # Resolve relative URLs to absolute URLs
-                abs_src = urljoin(page_url, url)
-                
-                # Create a sanitized, unique filename
-                try:
-                    ext = os.path.splitext(abs_src.split('?')[0])[1] or '.png' # Default extension
-                    filename_hash = hashlib.sha1(abs_src.encode()).hexdigest()[:10]
-                    filename = f"{filename_hash}{ext}"
-                    local_path = os.path.join(asset_dir, filename)
-                    # Path for the browser to use in the <img src="...">
-                    local_preview_path = f"/preview/assets/{filename}"
-                except Exception as e:
-                    await notif.log(f"Skipping invalid asset URL: {url} ({e})")
-                    logger.warning("Skipping invalid asset URL: %s (%s)", url, e)
-                    continue
-
-                if abs_src in asset_map: # Already processed
-                    continue
+    async def _download_assets(self, plan: dict[str, tuple[str, str]], notif: EventNotifier):
+        """Downloads a plan from `_plan_assets` concurrently, writing placeholders for failures."""
+        await notif.log(f"Found {len(plan)} unique assets to process...")
+        logger.info("Found %d unique assets to process", len(plan))
+        os.makedirs(os.path.join(CLONED_PROJECT_DIR, "assets"), exist_ok=True)
+
+        sem = asyncio.Semaphore(ASSET_FETCH_CONCURRENCY)
 
+        async def _fetch_one(abs_src, local_path, local_preview_path):
+            async with sem:
                 try:
                     await notif.log(f"Prefetching asset: {abs_src}")
                     logger.info("Prefetching asset: %s", abs_src)
-                    response = await client.get(abs_src, follow_redirects=True, timeout=10)
-                    response.raise_for_status()
-
-                    with open(local_path, 'wb') as f:
-                        f.write(response.content)
-                    
-                    asset_map[abs_src] = local_preview_path
-                    asset_map[url] = local_preview_path # Also map original URL
+                    await self._download_asset(abs_src, local_path)
                     logger.info("Successfully downloaded asset: %s -> %s", abs_src, local_preview_path)
 
-                except (httpx.RequestError, httpx.HTTPStatusError) as e:
+                except (httpx.RequestError, httpx.HTTPStatusError, OSError) as e:
                     await notif.log(f"Failed to download {abs_src}: {e}. Creating placeholder.")
                     logger.warning("Failed to download %s: %s. Creating placeholder.", abs_src, e)
-                    self._create_placeholder_image(local_path)
-                    asset_map[abs_src] = local_preview_path
-                    asset_map[url] = local_preview_path # Also map original URL
+                    await asyncio.to_thread(self._create_placeholder_image, local_path)
+            return abs_src
+
+        results = await asyncio.gather(
+            *[_fetch_one(abs_src, local_path, preview) for abs_src, (local_path, preview) in plan.items()],
+            return_exceptions=True,
+        )
 
-        await notif.log(f"Asset prefetch complete. Processed {len(asset_map)} assets.")
-        logger.info("Asset prefetch complete. Processed %d assets", len(asset_map))
-        return asset_map
+        for result in results:
+            if isinstance(result, BaseException):
+                logger.error("Asset prefetch task failed: %s", result)
 
-    async def _post_process_and_download_remaining_assets(self, html_content: str, page_url: str, notif: WebSocketEventNotifier) -> str:
-        """(Fallback) Finds any remaining remote image URLs, downloads them, and rewrites the HTML."""
+        await notif.log(f"Asset prefetch complete. Processed {len(plan)} assets.")
+        logger.info("Asset prefetch complete. Processed %d assets", len(plan))
+
+    async def _post_process_and_download_remaining_assets(self, html_content: str, page_url: str, notif: EventNotifier) -> str:
+        """(Fallback) Finds any remaining remote image URLs, downloads them concurrently, and rewrites the HTML.
+
+        The HTML is returned untouched when every image is already local.
+        """
         await notif.log("Starting post-processing of remaining assets...")
         logger.info("Starting post-processing of remaining assets for URL: %s", page_url)
         
-        soup = BeautifulSoup(html_content, 'lxml')
         asset_dir = os.path.join(CLONED_PROJECT_DIR, "assets")
         os.makedirs(asset_dir, exist_ok=True)
         
-        img_tags = soup.find_all('img')
-        await notif.log(f"Found {len(img_tags)} image tags to check...")
-        logger.info("Found %d image tags to check", len(img_tags))
-        
-        async with httpx.AsyncClient() as client:
-            for i, img in enumerate(img_tags):
-                src = img.get('src')
-                if not src or src.startswith(('/preview/assets/', '/assets/')) or src.startswith('data:'):
-                    continue # Skip local or data URI images
-
-                # Resolve relative URLs to absolute URLs
-                abs_src = urljoin(page_url, src)
-                
-                # Create a sanitized filename
-                filename = f"fallback_{i}_{os.path.basename(abs_src).split('?')[0]}"
-                local_path = os.path.join(asset_dir, filename)
-                
+        # Pass 1: collect the src attributes that need a local copy. Parsing
+        # (rather than pattern matching) skips <img> text inside scripts and comments
+        tree = LexborHTMLParser(html_content)
+        images = tree.css('img[src]')
+        await notif.log(f"Found {len(images)} image tags to check...")
+        logger.info("Found %d image tags to check", len(images))
+
+        items = []
+        for i, img in enumerate(images):
+            src = img.attributes.get('src')
+            if not src or src.startswith(('/preview/assets/', '/assets/')) or src.startswith('data:'):
+                continue # Skip local or data URI images
+
+            # Resolve relative URLs to absolute URLs
+            abs_src = urljoin(page_url, src)
+            
+            # Create a sanitized filename
+            filename = f"fallback_{i}_{os.path.basename(abs_src).split('?')[0]}"
+            local_path = os.path.join(asset_dir, filename)
+            items.append((i, abs_src, local_path, filename))
+
+        sem = asyncio.Semaphore(ASSET_FETCH_CONCURRENCY)
+
+        async def _fetch_one(item):
+            index, abs_src, local_path, filename = item
+            async with sem:
                 try:
                     await notif.log(f"Downloading fallback asset: {abs_src}")
                     logger.info("Downloading fallback asset: %s", abs_src)
-                    response = await client.get(abs_src, follow_redirects=True, timeout=10)
-                    response.raise_for_status()
-
-                    with open(local_path, 'wb') as f:
-                        f.write(response.content)
-                    
-                    # Rewrite the src to the new local path for the preview
-                    img['src'] = f"/preview/assets/{filename}"
+                    await self._download_asset(abs_src, local_path)
                     logger.info("Successfully downloaded fallback asset: %s -> %s", abs_src, filename)
 
-                except (httpx.RequestError, httpx.HTTPStatusError) as e:
+                except (httpx.RequestError, httpx.HTTPStatusError, OSError) as e:
                     await notif.log(f"Failed to download fallback {abs_src}: {e}. Creating placeholder.")
                     logger.warning("Failed to download fallback %s: %s. Creating placeholder.", abs_src, e)
-                    self._create_placeholder_image(local_path)
-                    img['src'] = f"/preview/assets/{filename}"
-        
+                    await asyncio.to_thread(self._create_placeholder_image, local_path)
+            return index, filename
+
+        results = await asyncio.gather(*[_fetch_one(i) for i in items], return_exceptions=True)
+
+        # Pass 2: rewrite the src to the new local path for the preview
+        rewritten = 0
+        for result in results:
+            if isinstance(result, BaseException):
+                logger.error("Fallback asset task failed: %s", result)
+                continue
+            index, filename = result
+            images[index].attrs['src'] = f"/preview/assets/{filename}"
+            rewritten += 1
+
         await notif.log("Post-processing of remaining assets complete.")
         logger.info("Post-processing of remaining assets complete")
-        return str(soup)
+        return tree.html if rewritten else html_content
 
     # --- ① two-pass DOM compression ---
+    async def _summarise_chunk(self, chunk: str) -> str:
+        pieces: list[str] = []
+        async with self.llm.messages.stream(
+            model="claude-3-haiku-20240307",
+            max_tokens=512,
+            system=PRE_SUMMARY_SYSTEM_PROMPT,
+            messages=[{"role": "user", "content": chunk}],
+        ) as stream:
+            async for tok in stream.text_stream:
+                pieces.append(tok)
+        return "".join(pieces).strip()
+
     async def _summarise_long_dom(self, raw_html: str) -> str:
         CHARS = 12000      # ≈3k tokens
-        parts = self._split_into_chunks(raw_html, CHARS)
-        summaries = []
-        for chunk in parts:
-            piece = ""
-            with self.llm.messages.stream(
-                model="claude-3-haiku-20240307",
-                max_tokens=512,
-                system=PRE_SUMMARY_SYSTEM_PROMPT,
-                messages=[{"role": "user", "content": chunk}],
-            ) as stream:
-                for tok in stream.text_stream:
-                    piece += tok
-            summaries.append(piece.strip())
-        tail = raw_html[:2000] + "\n...\n" + raw_html[-2000:]
-        return "\n\n".join(summaries) + "\n\nRAW_SAMPLE:\n" + tail
+        # Indentation and blank runs carry no layout information but cost tokens
+        text = _WHITESPACE_RE.sub(" ", raw_html)
+        parts = enumerate(self._split_into_chunks(text, CHARS))
+        summaries: dict[int, str] = {}
+
+        async def _worker():
+            # Workers share one iterator, so each chunk is taken exactly once
+            for i, chunk in parts:
+                summaries[i] = await self._summarise_chunk(chunk)
+
+        # A TaskGroup cancels the sibling workers if one summary fails
+        try:
+            async with asyncio.TaskGroup() as tg:
+                for _ in range(DOM_SUMMARY_CONCURRENCY):
+                    tg.create_task(_worker())
+        except ExceptionGroup as eg:
+            raise eg.exceptions[0] from eg # surface the failure itself to the caller
+        sample = f"RAW_SAMPLE:\n{text[:2000]}\n...\n{text[-2000:]}"
+        return "\n\n".join([*(summaries[i] for i in range(len(summaries))), sample])
 
     # --- ② Vision-Sonnet analysis ---
     async def _analyze_design_context_streaming(self, ctx: dict,
-                                                notif: WebSocketEventNotifier) -> str:
+                                                notif: EventNotifier,
+                                                screenshot=None) -> str:
         await notif.log("Starting DOM summarization...")
         logger.info("Starting DOM summarization")
         ctx["domTree"] = await self._summarise_long_dom(ctx["domTree"])
         await notif.log("DOM summarization complete. Starting design analysis...")
         logger.info("DOM summarization complete. Starting design analysis")
         
-        user_msg = json.dumps({"designContext": ctx}, default=json_default_serializer)
-
-        result = ""
-        with self.llm.messages.stream(
+        # Send the screenshot as a vision block rather than base64 inside the JSON;
+        # only non-image results still travel in designContext
+        image = screenshot_image_block(screenshot)
+        if screenshot is not None and image is None:
+            ctx = {**ctx, "viewportScreenshot": screenshot}
+        user_msg = orjson.dumps({"designContext": ctx}, default=json_default_serializer).decode()
+        content = [image, {"type": "text", "text": user_msg}] if image else user_msg
+
+        result: list[str] = []
+        async with self.llm.messages.stream(
             model="claude-sonnet-4-20250514",
             max_tokens=4096,
             system=ANALYSIS_SYSTEM_PROMPT,
-            messages=[{"role": "user", "content": user_msg}],
+            messages=[{"role": "user", "content": content}],
         ) as stream:
             logger.info(f"Stream object type: {type(stream)}")
             logger.info(f"Stream object attributes: {dir(stream)}")
@@ -349,62 +784,62 @@ class AppState:
                 
             # Log stream state before iteration
             logger.info("About to iterate over stream.text_stream")
-            for t in stream.text_stream:
+            async for t in stream.text_stream:
                 await notif.ai_token(t)
-                result += t
+                result.append(t)
         
         await notif.log("Design analysis complete.")
         logger.info("Design analysis complete")
-        return result
+        return "".join(result)
 
     # --- ③ Haiku HTML generation ---
     async def _generate_html_streaming(self, section_plan: str, ctx: dict,
-                                       notif: WebSocketEventNotifier) -> str:
+                                       notif: EventNotifier) -> str:
         await notif.log("Starting HTML generation...")
         logger.info("Starting HTML generation")
         
-        payload = json.dumps(
-            {"sectionPlan": json.loads(section_plan), "designContext": ctx},
+        payload = orjson.dumps(
+            {"sectionPlan": orjson.loads(section_plan), "designContext": ctx},
             default=json_default_serializer,
-        )
-        html = ""
-        with self.llm.messages.stream(
+        ).decode()
+        html: list[str] = []
+        async with self.llm.messages.stream(
             model="claude-sonnet-4-20250514",
             max_tokens=4096,
             system=HTML_GENERATION_SYSTEM_PROMPT,
             messages=[{"role": "user", "content": payload}],
         ) as stream:
-            for tok in stream.text_stream:
+            async for tok in stream.text_stream:
                 await notif.ai_token(tok)
-                html += tok
+                html.append(tok)
         
         await notif.log("HTML generation complete.")
         logger.info("HTML generation complete")
-        return html
+        return "".join(html)
 
     # --- (optional) bug-fix pass with Opus ---
     async def _fix_html_streaming(self, html: str,
-                                  notif: WebSocketEventNotifier) -> str:
+                                  notif: EventNotifier) -> str:
         await notif.log("Starting HTML bug-fix pass...")
         logger.info("Starting HTML bug-fix pass")
         
-        fixed = ""
-        with self.llm.messages.stream(
+        fixed: list[str] = []
+        async with self.llm.messages.stream(
             model="claude-opus-4-20250514",
             max_tokens=4096,
             system=BUG_FIXING_SYSTEM_PROMPT,
             messages=[{"role": "user", "content": html}],
         ) as stream:
-            for tok in stream.text_stream:
+            async for tok in stream.text_stream:
                 await notif.ai_token(tok)
-                fixed += tok
+                fixed.append(tok)
         
         await notif.log("HTML bug-fix pass complete.")
         logger.info("HTML bug-fix pass complete")
-        return fixed
+        return "".join(fixed)
 
     # --- Code Modification ---
-    async def modify_code_streaming(self, prompt: str, notif: WebSocketEventNotifier):
+    async def modify_code_streaming(self, prompt: str, notif: EventNotifier):
         try:
             await notif.log("Starting code modification process...")
             logger.info("Starting code modification with prompt: %s", prompt)
@@ -419,16 +854,16 @@ class AppState:
             await notif.log(f"Applying modification: '{prompt}'...")
             logger.info("Applying modification: %s", prompt)
             
-            with open(file_path, "r", encoding="utf-8") as f:
-                current_content = f.read()
+            async with aiofiles.open(file_path, "r", encoding="utf-8") as f:
+                current_content = await f.read()
 
             await notif.log("Sending modification request to AI...")
             logger.info("Sending modification request to AI")
 
             user_message = f"USER REQUEST: {prompt}\n\nCURRENT HTML:\n```html\n{current_content}\n```"
             
-            modified_content = ""
-            with self.llm.messages.stream(
+            modified_content: list[str] = []
+            async with self.llm.messages.stream(
                 model="claude-3-opus-20240229",
                 max_tokens=8192, # Allow for larger files
                 system=MODIFICATION_SYSTEM_PROMPT,
@@ -436,18 +871,18 @@ class AppState:
             ) as stream:
                 async for tok in stream.text_stream:
                     await notif.ai_token(tok)
-                    modified_content += tok
+                    modified_content.append(tok)
 
             await notif.log("Processing AI response...")
             logger.info("Processing AI response")
 
             # Basic cleanup of the response
-            final_content = re.sub(r'```html\n(.*?)\n```', r'\1', modified_content, flags=re.S).strip()
+            final_content = strip_html_fence("".join(modified_content))
 
             await notif.log("Writing modified content to file...")
             logger.info("Writing modified content to file: %s", file_path)
             
-            write_file(file_path, final_content)
+            await write_file(file_path, final_content)
             await notif.file_event("file_update", "index.html", content=final_content, old=current_content)
             await notif.log("✅ Modification complete!")
             logger.info("Code modification complete")
@@ -460,7 +895,8 @@ class AppState:
             await notif.log(f"Error during modification: {e}")
 
     # --- Orchestrator ---
-    async def clone_website(self, url: HttpUrl, notif: WebSocketEventNotifier):
+    async def clone_website(self, url: HttpUrl, notif: EventNotifier):
+        download_task = None
         try:
             await notif.status_update("generating")
             await notif.log("Starting website cloning process...")
@@ -485,6 +921,8 @@ class AppState:
             await notif.log("Gathering design context …")
             logger.info("Gathering design context")
             
+            # Kept sequential: every tool drives the server's single Playwright page,
+            # and concurrent navigations/screenshots on it are not known to be safe
             await notif.log("Taking screenshot...")
             logger.info("Taking screenshot")
             screenshot = await self.mcp_client.session.call_tool(
@@ -507,16 +945,18 @@ class AppState:
             logger.info("Building design context")
             design_ctx = {
                 "pageUrl": str(url),
-                "viewportScreenshot": screenshot.content[0],
                 "domTree": str(dom_info.content[0]),
                 "analysis": str(analysis.content[0]),
             }
 
-            # Prefetch assets and add them to the design context
+            # Plan asset paths for the design context; the downloads only need
+            # to finish before the final HTML is written, so they overlap the AI stages
             await notif.log("Prefetching assets...")
             logger.info("Starting asset prefetch")
-            asset_map = await self._prefetch_assets(design_ctx["domTree"], str(url), notif)
+            asset_urls = self._extract_asset_urls(analysis.content[0], design_ctx["domTree"])
+            asset_plan, asset_map = self._plan_assets(asset_urls, str(url))
             design_ctx["assets"] = asset_map
+            download_task = asyncio.create_task(self._download_assets(asset_plan, notif))
 
             await notif.log("Sanitizing HTML content...")
             logger.info("Sanitizing HTML content")
@@ -530,7 +970,8 @@ class AppState:
             # 2. AI analysis
             await notif.log("AI (Sonnet): analysing layout …")
             logger.info("Starting AI layout analysis")
-            section_plan = await self._analyze_design_context_streaming(design_ctx, notif)
+            section_plan = await self._analyze_design_context_streaming(
+                design_ctx, notif, screenshot=screenshot.content[0])
 
             # await notif.log(f"section_plan: {section_plan}")
             # 3. HTML generation
@@ -543,6 +984,10 @@ class AppState:
             logger.info("Starting HTML bug-fix pass")
             fixed_html = await self._fix_html_streaming(raw_html, notif)
 
+            await notif.log("Waiting for asset prefetch to finish...")
+            logger.info("Waiting for asset prefetch to finish")
+            await download_task
+
             # 5. Asset Pipeline: Download images and rewrite paths
             await notif.log("Post-processing assets (images)...")
             logger.info("Starting asset post-processing")
@@ -552,7 +997,7 @@ class AppState:
             await notif.log("Writing final HTML file...")
             logger.info("Writing final HTML file")
             file_path = os.path.join(CLONED_PROJECT_DIR, "index.html")
-            write_file(file_path, final_html)
+            await write_file(file_path, final_html)
             await notif.file_event("file_create", "index.html", final_html)
 
             await notif.status_update("ready")
@@ -564,18 +1009,23 @@ class AppState:
             await notif.status_update("error")
             await notif.log(f"Error: {e}")
         finally:
-            # Keep connection open for modifications
-            pass
+            # Keep connection open for modifications; only stop stray downloads
+            if download_task and not download_task.done():
+                download_task.cancel()
 
 # ─── FastAPI setup ──────────────────────────────────────────────────────────
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info("Startup …")
+    service = None
     try:
-        app.state.service = AppState()
+        service = app.state.service = AppState()
         yield
     finally:
         logger.info("Shutdown …")
+        # Close the service this lifespan built, even if another one replaced it on app.state
+        if service is not None:
+            await service.http.aclose()
 
 app = FastAPI(title="HTML-Tailwind Cloner", lifespan=lifespan)
 
@@ -619,6 +1069,7 @@ async def websocket_clone(ws: WebSocket):
             
     except WebSocketDisconnect:
         logger.info("Client disconnected.")
+        notifier.cancel_flush()
         if clone_task and not clone_task.done():
             clone_task.cancel()
     except Exception as e:
@@ -630,17 +1081,43 @@ async def websocket_clone(ws: WebSocket):
             except:
                 pass
 
+# ─── SSE endpoint ───────────────────────────────────────────────────────────
+@app.get("/stream/clone")
+async def stream_clone(url: HttpUrl, request: Request):
+    """Runs a clone and streams its events as Server-Sent Events."""
+    notifier = SSEEventNotifier()
+
+    async def run_clone():
+        try:
+            await request.app.state.service.clone_website(url, notifier)
+        finally:
+            await notifier.close()
+
+    clone_task = asyncio.create_task(run_clone())
+
+    async def event_stream():
+        try:
+            async for frame in notifier.events():
+                yield frame
+        finally:
+            # Client went away before the clone finished
+            notifier.detach()
+            if not clone_task.done():
+                clone_task.cancel()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # ─── Simple helpers for UI preview ─────────────────────────────────────────
 @app.get("/files/tree")
-async def files_tree():
-    tree = []
-    for root, _, files in os.walk(CLONED_PROJECT_DIR):
-        if not os.path.exists(CLONED_PROJECT_DIR):
-            return {"tree": []}
-        rel = os.path.relpath(root, CLONED_PROJECT_DIR)
-        for f in files:
-            tree.append(os.path.join("" if rel == "." else rel, f))
-    return {"tree": tree}
+async def files_tree(request: Request):
+    tree, etag = request.app.state.service.list_project_files()
+    if etag and request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return JSONResponse({"tree": tree}, headers={"ETag": etag} if etag else None)
 
 @app.get("/files/content")
 async def file_content(path: str):
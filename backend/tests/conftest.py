@@ -1,7 +1,36 @@
 import sys
 import os
+
+import pytest
+from fastapi.testclient import TestClient
+from httpx import ASGITransport, AsyncClient
  
-# Add the project root to the Python path to allow for absolute imports
-# of modules like `mcp_client` from the `backend` directory.
+# Add the project root to the Python path so `backend` imports as a package;
+# main.py pulls in its siblings with relative imports (`from .mcp_client ...`).
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
-sys.path.insert(0, project_root) 
\ No newline at end of file
+sys.path.insert(0, project_root)
+
+# The app lifespan builds an AppState, which refuses to start without a key
+os.environ.setdefault("ANTHROPIC_API_KEY", "test-key")
+
+from backend.main import app
+
+# --- Shared fixtures ---
+
+@pytest.fixture(scope="session")
+async def app_lifespan():
+    """Runs the app lifespan once, on the session event loop, for the in-process async client."""
+    async with app.router.lifespan_context(app):
+        yield
+
+@pytest.fixture
+async def async_client(app_lifespan):
+    """In-process async client for plain HTTP endpoints, with no portal thread hop."""
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as c:
+        yield c
+
+@pytest.fixture(scope="session")
+def client():
+    """Session-wide TestClient, kept for the websocket and SSE tests."""
+    with TestClient(app) as c:
+        yield c
@@ -1,26 +1,24 @@
 import pytest
 import os
+import asyncio
+import copy
 import json
+from types import SimpleNamespace
+
+import httpx
 from unittest.mock import MagicMock, AsyncMock, patch
 
-from fastapi.testclient import TestClient
 from fastapi.websockets import WebSocketState
 from pydantic import HttpUrl
 
-# Adjust the import path to be relative to the project structure
-import sys
-# This ensures that the tests can find the 'main' module and its dependencies
-sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-
-from main import app, AppState, CLONED_PROJECT_DIR
+# conftest.py puts the project root on sys.path, so `backend` imports as a package
+from backend.main import (
+    AI_TOKEN_FLUSH_INTERVAL, AppState, CLONED_PROJECT_DIR, WebSocketEventNotifier, SSEEventNotifier,
+    screenshot_image_block, strip_html_fence, strip_scripts,
+)
 
 # --- Fixtures ---
-
-@pytest.fixture
-def client():
-    """Fixture for the TestClient, used to test API endpoints."""
-    with TestClient(app) as c:
-        yield c
+# `client` is session-scoped and lives in conftest.py
 
 @pytest.fixture
 def temp_project_dir(tmp_path):
@@ -29,102 +27,397 @@ def temp_project_dir(tmp_path):
     project_path.mkdir()
     return project_path
 
+@pytest.fixture(scope="module")
+def app_state():
+    """One AppState per module; tests monkeypatch what they need on it."""
+    return AppState()
+
+@pytest.fixture(autouse=True)
+def _patch_cloned_dir(monkeypatch, temp_project_dir):
+    """Points every test at its own temporary project directory."""
+    monkeypatch.setattr('backend.main.CLONED_PROJECT_DIR', str(temp_project_dir))
+
+# --- Fake LLM client ---
+
+class _FakeStream:
+    """Stands in for an Anthropic message stream: an async context manager with `text_stream`."""
+    def __init__(self, chunks):
+        self._chunks = chunks
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    @property
+    async def text_stream(self):
+        for chunk in self._chunks:
+            yield chunk
+
+class _FakeMessages:
+    """Hands out one `_FakeStream` per `stream()` call and records the kwargs of each."""
+    def __init__(self, chunks_per_call):
+        self._chunks_per_call = iter(chunks_per_call)
+        self.calls = []
+
+    def stream(self, **kw):
+        self.calls.append(kw)
+        return _FakeStream(next(self._chunks_per_call))
+
+def make_llm(chunks_per_call):
+    """A fake `llm` client whose n-th `messages.stream()` yields `chunks_per_call[n]`."""
+    return SimpleNamespace(messages=_FakeMessages(chunks_per_call))
+
 # --- Unit Tests for AppState Core Logic ---
 
-@pytest.mark.asyncio
-async def test_summarise_long_dom_chunks_data():
-    """Tests that a long HTML string is correctly chunked and summarized."""
-    app_state = AppState()
+@pytest.fixture(scope="session")
+def long_html():
+    """A DOM dump long enough to be chunked before summarising."""
+    return "a" * 20000
+
+async def test_summarise_long_dom(app_state, monkeypatch, long_html):
+    """A long DOM is chunked, each chunk summarised by Haiku, and a raw sample appended."""
     # Make the chunk size small to force chunking
-    app_state._split_into_chunks = lambda text, size: [text[:size], text[size:]]
+    monkeypatch.setattr(app_state, "_split_into_chunks", lambda text, size: [text[:size], text[size:]])
+    monkeypatch.setattr(app_state, "llm", make_llm([["summary1 "], ["summary2"]]))
 
-    mock_stream = AsyncMock()
-    mock_stream.text_stream.__aiter__.return_value = ["summary1 "].__iter__()
-    
-    mock_stream2 = AsyncMock()
-    mock_stream2.text_stream.__aiter__.return_value = ["summary2"].__iter__()
+    result = await app_state._summarise_long_dom(long_html)
 
-    # Have the mock return different values on subsequent calls
-    app_state.llm.messages.stream = MagicMock(side_effect=[mock_stream, mock_stream2])
+    calls = app_state.llm.messages.calls
+    assert len(calls) == 2
+    for kwargs in calls:
+        assert kwargs['model'] == "claude-3-haiku-20240307"
+        assert "Summarise the layout & styling cues" in kwargs['system']
+    assert result == "summary1\n\nsummary2\n\nRAW_SAMPLE:\n" + "a" * 2000 + "\n...\n" + "a" * 2000
 
-    long_html = "a" * 20000
-    result = await app_state._summarise_long_dom(long_html)
+@pytest.mark.parametrize(
+    "method_name, args, system_substr, chunks, expected",
+    [
+        ("_analyze_design_context_streaming", ({"domTree": "<html>...</html>"},),
+         "You are Vision-Sonnet", ['{"sectionPlan":', '["Hero"]}'], '{"sectionPlan":["Hero"]}'),
+        ("_generate_html_streaming", ('[]', {}),
+         "You are Opus (Claude) acting as a precise front-end coder.", ["<html>", "</html>"], "<html></html>"),
+    ],
+    ids=["analyze_design_context", "generate_html"],
+)
+async def test_llm_streaming_methods(app_state, monkeypatch, method_name, args, system_substr, chunks, expected):
+    """Tests the streaming LLM helpers: model, system prompt, result and forwarded tokens."""
+    args = copy.deepcopy(args) # the analysis step rewrites ctx["domTree"] in place
+    mock_notifier = AsyncMock()
+    monkeypatch.setattr(app_state, "llm", make_llm([chunks]))
+    monkeypatch.setattr(app_state, "_summarise_long_dom", AsyncMock(return_value="summarized_dom"))
 
-    assert app_state.llm.messages.stream.call_count == 2
-    assert "summary1" in result
-    assert "summary2" in result
-    assert "RAW_SAMPLE" in result
+    result = await getattr(app_state, method_name)(*args, mock_notifier)
 
+    calls = app_state.llm.messages.calls
+    assert len(calls) == 1
+    assert calls[0]['model'] == "claude-sonnet-4-20250514"
+    assert system_substr in calls[0]['system']
+    assert result == expected
+    assert mock_notifier.ai_token.call_count == len(chunks)
 
-@pytest.mark.asyncio
-async def test_analyze_design_context_streaming():
-    """Tests the design context analysis, mocking the summarizer and LLM."""
-    app_state = AppState()
-    mock_notifier = AsyncMock()
-    
-    with patch.object(app_state, '_summarise_long_dom', new_callable=AsyncMock, return_value="summarized_dom") as mock_summarize:
-        
-        async def mock_text_stream():
-            yield '{"sectionPlan":'
-            yield '["Hero"]}'
+async def test_analyze_design_context_summarises_dom(app_state, monkeypatch):
+    """The DOM tree is handed to the summariser before the analysis prompt is built."""
+    summarise = AsyncMock(return_value="summarized_dom")
+    monkeypatch.setattr(app_state, "llm", make_llm([['{}']]))
+    monkeypatch.setattr(app_state, "_summarise_long_dom", summarise)
 
-        app_state.llm.messages.stream = MagicMock()
-        app_state.llm.messages.stream.return_value.text_stream = mock_text_stream()
-        
-        test_context = {"domTree": "<html>...</html>"}
-        result = await app_state._analyze_design_context_streaming(test_context, mock_notifier)
+    await app_state._analyze_design_context_streaming({"domTree": "<html>...</html>"}, AsyncMock())
 
-        mock_summarize.assert_called_once_with("<html>...</html>")
-        
-        # Verify the correct model and system prompt were used
-        call_args = app_state.llm.messages.stream.call_args
-        assert call_args.kwargs['model'] == "claude-sonnet-4-20250514"
-        assert "You are Vision-Sonnet" in call_args.kwargs['system']
-        
-        assert result == '{"sectionPlan":["Hero"]}'
-        assert mock_notifier.ai_token.call_count == 2
+    summarise.assert_called_once_with("<html>...</html>")
 
+@pytest.mark.parametrize(
+    "analysis, dom_html, expected",
+    [
+        # Entries with a URL key, URL-shaped bare strings and nested lists; the DOM is not parsed
+        ({"images": [{"src": "https://cdn.x/a.png", "alt": "A"}, "/img/b.jpg", "c.webp?v=2"],
+          "layout": {"icons": [[{"href": "favicon.ico"}]]}},
+         '<img src="dom.png">', ["https://cdn.x/a.png", "/img/b.jpg", "c.webp?v=2", "favicon.ico"]),
+        # Metadata strings are not URLs
+        ({"images": [{"source": "hero.png", "alt": "Hero", "width": "1200"}], "icons": {"count": "3"},
+          "assets": ["Hero image", "1200", "1.5"]},
+         "", []),
+        # Stylesheets, scripts, fragments, the bare site and other schemes are not images
+        ({"images": [{"type": "stylesheet", "href": "main.css"}, {"src": "app.js"}, {"href": "#top"},
+                     "Node.js", "https://example.com", "mailto:a@b.c"]},
+         "", []),
+        # Only a favicon from the analyzer: the DOM supplies the images
+        ({"icons": [{"href": "/favicon.ico"}]},
+         '<link rel="icon" href="/icon.png"><link rel="stylesheet" href="s.css"><img src="hero.png"><img alt="x">'
+         '<img src="#"><img src="javascript:void(0)"><img src="/api/img?id=3">',
+         ["/favicon.ico", "hero.png", "/api/img?id=3", "/icon.png"]),
+    ],
+    ids=["analyzer_fast_path", "metadata_ignored", "non_image_refs", "favicon_only_scans_dom"],
+)
+def test_extract_asset_urls(app_state, analysis, dom_html, expected):
+    """Tests which analyzer values and DOM tags are taken as asset URLs."""
+    # The analyzer result arrives as MCP text content holding JSON
+    content = SimpleNamespace(text=json.dumps(analysis))
+    assert app_state._extract_asset_urls(content, dom_html) == expected
 
-@pytest.mark.asyncio
-async def test_generate_html_streaming():
-    """Tests HTML generation, mocking the LLM."""
-    app_state = AppState()
-    mock_notifier = AsyncMock()
-    
-    async def mock_text_stream():
-        yield "<html>"
-        yield "</html>"
-        
-    app_state.llm.messages.stream = MagicMock()
-    app_state.llm.messages.stream.return_value.text_stream = mock_text_stream()
+def test_extract_asset_urls_unparseable_analysis(app_state):
+    """Tests that non-JSON analyzer output falls back to the DOM alone."""
+    content = SimpleNamespace(text="not json")
+    assert app_state._extract_asset_urls(content, '<img src="a.png">') == ["a.png"]
 
-    result = await app_state._generate_html_streaming('[]', {}, mock_notifier)
+async def test_summarise_long_dom_cancels_siblings_on_failure(app_state, monkeypatch, long_html):
+    """Tests that one failing chunk summary cancels the ones still in flight."""
+    chunks = [long_html[:100], long_html[100:200], long_html[200:300]]
+    cancelled = []
 
-    # Verify the correct model and system prompt were used
-    call_args = app_state.llm.messages.stream.call_args
-    assert call_args.kwargs['model'] == "claude-opus-4-20250514"
-    assert "You are Opus (Claude) acting as a precise front-end coder." in call_args.kwargs['system']
-    
-    assert result == "<html></html>"
-    assert mock_notifier.ai_token.call_count == 2
+    async def fake_summarise_chunk(chunk):
+        if chunk is chunks[0]:
+            await asyncio.sleep(0) # let the other workers pick up their chunks first
+            raise ValueError("boom")
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(chunk)
+            raise
+
+    monkeypatch.setattr(app_state, "_split_into_chunks", lambda text, size: iter(chunks))
+    monkeypatch.setattr(app_state, "_summarise_chunk", fake_summarise_chunk)
+
+    with pytest.raises(ValueError, match="boom"):
+        await app_state._summarise_long_dom(long_html)
+    assert cancelled == chunks[1:]
+
+@pytest.fixture
+async def asset_http(app_state, monkeypatch, tmp_path):
+    """Serves asset downloads from a MockTransport and points the cache at tmp_path.
+
+    Each response is taken from `routes` (url -> httpx.Response factory); every request is recorded.
+    """
+    requests, routes = [], {}
+
+    def handler(request):
+        requests.append(request)
+        return routes[str(request.url)](request)
+
+    monkeypatch.setattr('backend.main.ASSET_CACHE_DIR', str(tmp_path / "cache"))
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as http:
+        monkeypatch.setattr(app_state, "http", http)
+        yield SimpleNamespace(requests=requests, routes=routes, cache_dir=tmp_path / "cache")
+
+async def test_download_asset_cache_miss_then_hit(app_state, asset_http, temp_project_dir):
+    """Tests that a cached asset is reused across runs with a single network fetch."""
+    asset_http.routes["https://cdn.x/a.png"] = lambda r: httpx.Response(200, content=b"png-bytes")
+    first, second = temp_project_dir / "first.png", temp_project_dir / "second.png"
+
+    await app_state._download_asset("https://cdn.x/a.png", str(first))
+    await app_state._download_asset("https://cdn.x/a.png", str(second))
+
+    assert len(asset_http.requests) == 1
+    assert first.read_bytes() == second.read_bytes() == b"png-bytes"
+
+async def test_download_asset_revalidates_stale_copy(app_state, asset_http, monkeypatch, temp_project_dir):
+    """Tests that an expired copy is revalidated with its ETag and kept on 304."""
+    def respond(request):
+        if request.headers.get("If-None-Match") == '"v1"':
+            return httpx.Response(304)
+        return httpx.Response(200, content=b"v1", headers={"ETag": '"v1"'})
+    asset_http.routes["https://cdn.x/a.png"] = respond
+    monkeypatch.setattr('backend.main.ASSET_CACHE_MAX_AGE', 0)
+
+    await app_state._download_asset("https://cdn.x/a.png", str(temp_project_dir / "a.png"))
+    await app_state._download_asset("https://cdn.x/a.png", str(temp_project_dir / "b.png"))
+
+    assert [r.headers.get("If-None-Match") for r in asset_http.requests] == [None, '"v1"']
+    assert (temp_project_dir / "b.png").read_bytes() == b"v1"
+
+async def test_download_asset_http_error_leaves_no_partial_file(app_state, asset_http, temp_project_dir):
+    """Tests that a failed download raises and leaves nothing behind in the cache."""
+    asset_http.routes["https://cdn.x/missing.png"] = lambda r: httpx.Response(404)
+
+    with pytest.raises(httpx.HTTPStatusError):
+        await app_state._download_asset("https://cdn.x/missing.png", str(temp_project_dir / "m.png"))
+
+    assert list(asset_http.cache_dir.iterdir()) == []
+    assert not (temp_project_dir / "m.png").exists()
+
+async def test_download_asset_unusable_cache_dir(app_state, asset_http, monkeypatch, tmp_path, temp_project_dir):
+    """Tests that assets still land in the project when the cache directory cannot be created."""
+    blocker = tmp_path / "not_a_dir"
+    blocker.write_text("")
+    monkeypatch.setattr('backend.main.ASSET_CACHE_DIR', str(blocker / "assets"))
+    asset_http.routes["https://cdn.x/a.png"] = lambda r: httpx.Response(200, content=b"png-bytes")
+
+    await app_state._download_asset("https://cdn.x/a.png", str(temp_project_dir / "a.png"))
+
+    assert (temp_project_dir / "a.png").read_bytes() == b"png-bytes"
+    assert [p.name for p in temp_project_dir.iterdir()] == ["a.png"]
+
+def test_plan_assets_skips_non_http_urls(app_state):
+    """Tests that only http(s) URLs are planned, with relative aliases sharing one file."""
+    urls = ["/logo.png", "logo.png", "data:image/png;base64,AA", "mailto:a@b.c", "javascript:void(0)"]
+    plan, asset_map = app_state._plan_assets(urls, "https://x.com/")
+
+    assert list(plan) == ["https://x.com/logo.png"]
+    assert asset_map["/logo.png"] == asset_map["logo.png"] == plan["https://x.com/logo.png"][1]
+
+async def test_post_process_rewrites_only_real_img_tags(app_state, monkeypatch):
+    """Tests that fallback rewriting follows parsed <img> tags, not look-alike text."""
+    script = '<script>el.innerHTML = "<img src=\\"https://cdn.x/i.png\\">";</script>'
+    html = ('<img alt="a > b" src="https://cdn.x/hero.png">' + script +
+            '<img src=https://cdn.x/bare.png><!-- <img src="https://cdn.x/c.png"> -->')
+    mock_download = AsyncMock()
+    monkeypatch.setattr(app_state, "_download_asset", mock_download)
+
+    result = await app_state._post_process_and_download_remaining_assets(html, "https://x.com/", AsyncMock())
+
+    assert [c.args[0] for c in mock_download.call_args_list] == ["https://cdn.x/hero.png", "https://cdn.x/bare.png"]
+    assert 'src="/preview/assets/fallback_0_hero.png"' in result
+    assert 'src="/preview/assets/fallback_1_bare.png"' in result
+    assert script in result
+    assert '<!-- <img src="https://cdn.x/c.png"> -->' in result
+
+async def test_post_process_keeps_local_html_untouched(app_state, monkeypatch):
+    """Tests that HTML whose images are all local is returned as-is."""
+    html = '<p>hi</p><img src="/preview/assets/a.png"><img src="data:image/png;base64,AA">'
+    mock_download = AsyncMock()
+    monkeypatch.setattr(app_state, "_download_asset", mock_download)
+
+    result = await app_state._post_process_and_download_remaining_assets(html, "https://x.com/", AsyncMock())
+
+    assert result == html
+    mock_download.assert_not_called()
+
+async def test_analyze_design_context_sends_screenshot_as_image(app_state, monkeypatch):
+    """Tests that an image screenshot goes to Sonnet as a vision block, not inside designContext."""
+    monkeypatch.setattr(app_state, "llm", make_llm([["[]"], ["<html></html>"]]))
+    monkeypatch.setattr(app_state, "_summarise_long_dom", AsyncMock(return_value="summary"))
+    screenshot = SimpleNamespace(type="image", data="QUJD", mimeType="image/jpeg")
+    ctx = {"pageUrl": "https://x.com/", "domTree": "<html></html>"}
+
+    await app_state._analyze_design_context_streaming(ctx, AsyncMock(), screenshot=screenshot)
+    await app_state._generate_html_streaming("[]", ctx, AsyncMock())
+
+    analysis_call, generation_call = app_state.llm.messages.calls
+    image, text = analysis_call["messages"][0]["content"]
+    assert image == {"type": "image", "source": {"type": "base64", "media_type": "image/jpeg", "data": "QUJD"}}
+    assert "viewportScreenshot" not in json.loads(text["text"])["designContext"]
+    # The generation payload carries no screenshot in any form
+    payload = generation_call["messages"][0]["content"]
+    assert "QUJD" not in payload and "viewportScreenshot" not in payload
+
+async def test_analyze_design_context_inlines_non_image_screenshot(app_state, monkeypatch):
+    """Tests that a non-image screenshot result is passed along as designContext.viewportScreenshot."""
+    monkeypatch.setattr(app_state, "llm", make_llm([["[]"]]))
+    monkeypatch.setattr(app_state, "_summarise_long_dom", AsyncMock(return_value="summary"))
+    ctx = {"pageUrl": "https://x.com/", "domTree": "<html></html>"}
+
+    await app_state._analyze_design_context_streaming(ctx, AsyncMock(), screenshot={"type": "text", "text": "saved"})
+
+    content = app_state.llm.messages.calls[0]["messages"][0]["content"]
+    assert isinstance(content, str)
+    assert json.loads(content)["designContext"]["viewportScreenshot"] == {"type": "text", "text": "saved"}
+    assert "viewportScreenshot" not in ctx
+
+# --- Tests for the module-level helpers ---
+
+@pytest.mark.parametrize(
+    "item, expected",
+    [
+        (SimpleNamespace(type="image", data="QUJD", mimeType="image/webp"),
+         {"type": "image", "source": {"type": "base64", "media_type": "image/webp", "data": "QUJD"}}),
+        (SimpleNamespace(type="image", data="QUJD", mimeType=None),
+         {"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": "QUJD"}}),
+        (SimpleNamespace(type="text", text="QUJD"), None),
+        (SimpleNamespace(type="image", data=None), None),
+    ],
+    ids=["image", "default_media_type", "text", "no_data"],
+)
+def test_screenshot_image_block(item, expected):
+    """Tests which MCP results become Anthropic image blocks."""
+    assert screenshot_image_block(item) == expected
+
+@pytest.mark.parametrize(
+    "html, expected",
+    [
+        ('<p>a</p><script src="x.js"></script><p>b</p>', "<p>a</p><p>b</p>"),
+        ("<SCRIPT type='module'>let a = 1 > 0;</Script ><p>b</p>", "<p>b</p>"),
+        ("<p>a</p><script>never closed", "<p>a</p>"),
+        ("<p>a</p><script", "<p>a</p>"),
+        ("<scripts>kept</scripts>", "<scripts>kept</scripts>"),
+    ],
+    ids=["basic", "mixed_case", "unclosed", "unterminated_tag", "not_a_script"],
+)
+def test_strip_scripts(html, expected):
+    """Tests that script elements are removed and everything else is kept."""
+    assert strip_scripts(html) == expected
+
+def test_strip_scripts_unclosed_run_is_linear():
+    """Tests that a long run of unclosed tags is dropped in one pass (a backtracking regex never finishes)."""
+    assert strip_scripts("<p>a</p>" + "<script>" * 200_000) == "<p>a</p>"
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("```html\n<p>x</p>\n```", "<p>x</p>"),
+        ("```html\n<p>x</p>\n```\nHope this helps!", "<p>x</p>"),
+        ("```html\n<p>x</p>\n```\nNote: use ```css``` for more", "<p>x</p>"),
+        ("```html<p>x</p>```", "<p>x</p>"),
+        ("```html\n<p>x</p>", "<p>x</p>"),
+        ("Here you go:\n```html\n<p>x</p>\n```\nEnjoy", "Here you go:\n<p>x</p>\nEnjoy"),
+        ("  <p>x</p>\n", "<p>x</p>"),
+    ],
+    ids=["fenced", "trailing_chatter", "chatter_with_fences", "one_line", "unclosed", "fence_mid_text", "no_fence"],
+)
+def test_strip_html_fence(text, expected):
+    """Tests that ```html fences are removed wherever the model puts them."""
+    assert strip_html_fence(text) == expected
+
+# --- Tests for the WebSocket notifier ---
+
+async def test_notifier_cancel_flush_stops_timed_send():
+    """Tests that a pending timed token flush is cancelled once the client is gone."""
+    notifier = WebSocketEventNotifier(AsyncMock())
+    await notifier.ai_token("<html>")
+    notifier.cancel_flush()
+    await asyncio.sleep(AI_TOKEN_FLUSH_INTERVAL * 2)
+
+    assert notifier._flush_task.cancelled()
+    notifier.ws.send_text.assert_not_called()
+
+async def test_notifier_timed_flush_swallows_closed_socket():
+    """Tests that a timed flush onto a closed socket does not leave a failed task behind."""
+    notifier = WebSocketEventNotifier(AsyncMock())
+    notifier.ws.send_text.side_effect = RuntimeError("Cannot call \"send\" once a close message has been sent.")
+    await notifier.ai_token("<html>")
+    await notifier._flush_task
+
+    assert notifier._flush_task.exception() is None
+    notifier.ws.send_text.assert_called_once()
+
+async def test_sse_notifier_detach_unblocks_close():
+    """Tests that a full SSE queue with no reader left does not hang the clone task's close()."""
+    notifier = SSEEventNotifier()
+    for i in range(notifier.queue.maxsize):
+        await notifier.log(f"line {i}")
+    assert notifier.queue.full()
+
+    notifier.detach()
+    await notifier.log("dropped")
+    await asyncio.wait_for(notifier.close(), timeout=1)
+    assert notifier.queue.qsize() == notifier.queue.maxsize
 
 # --- Test for the Main Orchestrator ---
 
-@pytest.mark.asyncio
-async def test_clone_website_orchestration():
+async def test_clone_website_orchestration(app_state, monkeypatch, temp_project_dir):
     """Tests the high-level orchestration of the clone_website method."""
-    app_state = AppState()
     mock_notifier = AsyncMock()
     # Mock the websocket state to prevent an error on close
     mock_notifier.ws.application_state = WebSocketState.CONNECTED
     test_url = HttpUrl("https://example.com")
     
     # Mock all external dependencies and helpers
-    with patch('main.shutil.rmtree'), \
-         patch('main.os.makedirs'), \
-         patch('main.write_file') as mock_write_file, \
+    with patch('backend.main.shutil.rmtree'), \
+         patch('backend.main.os.makedirs'), \
+         patch('backend.main.write_file') as mock_write_file, \
          patch.object(app_state, '_analyze_design_context_streaming', return_value='[{"componentName": "Test"}]') as mock_analyze, \
          patch.object(app_state, '_generate_html_streaming', return_value='<html></html>') as mock_generate, \
+         patch.object(app_state, '_fix_html_streaming', return_value='<html></html>') as mock_fix, \
          patch.object(app_state.mcp_client, 'connect_to_server', new_callable=AsyncMock), \
          patch.object(app_state.mcp_client, 'cleanup', new_callable=AsyncMock) as mock_cleanup:
         
@@ -134,13 +427,17 @@ async def test_clone_website_orchestration():
         mock_dom = MagicMock(content=[{"domTree": "...", "styles": {}}])
         mock_analysis = MagicMock(content=[{"layoutTree": []}])
 
+        _tool_returns = {
+            "screenshot_url": mock_screenshot,
+            "dom_inspector": mock_dom,
+            "enhanced_page_analyzer": mock_analysis,
+        }
+
         async def mock_call_tool_side_effect(tool_name, *args, **kwargs):
-            if tool_name == "screenshot_url": return mock_screenshot
-            if tool_name == "dom_inspector": return mock_dom
-            if tool_name == "enhanced_page_analyzer": return mock_analysis
+            return _tool_returns.get(tool_name)
         
         mock_session.call_tool = AsyncMock(side_effect=mock_call_tool_side_effect)
-        app_state.mcp_client.session = mock_session
+        monkeypatch.setattr(app_state.mcp_client, "session", mock_session)
         
         await app_state.clone_website(test_url, mock_notifier)
         
@@ -148,53 +445,107 @@ async def test_clone_website_orchestration():
         mock_notifier.log.assert_any_call("Connecting to AI-Vision server …")
         mock_session.call_tool.assert_any_call("playwright_navigate", {"url": "https://example.com/"})
         mock_analyze.assert_called_once()
+        assert mock_analyze.call_args.kwargs["screenshot"] == "fake_screenshot_data"
         mock_generate.assert_called_once()
-        mock_write_file.assert_called_once_with(os.path.join(CLONED_PROJECT_DIR, "index.html"), "<html></html>")
+        mock_fix.assert_called_once_with('<html></html>', mock_notifier)
+        mock_write_file.assert_called_once_with(os.path.join(str(temp_project_dir), "index.html"), "<html></html>")
         mock_cleanup.assert_called_once()
         mock_notifier.log.assert_any_call("✅ Cloning complete – open cloned_project/index.html!")
 
 # --- API Endpoint Tests ---
 
-def test_root_endpoint(client):
+async def test_root_endpoint(async_client):
     """Tests the root endpoint, which should always return a 200 OK."""
-    response = client.get("/")
+    response = await async_client.get("/")
     assert response.status_code == 200
     assert response.json() == {"message": "Backend is running"}
 
-def test_get_files_tree_endpoint(client, temp_project_dir):
+async def test_get_files_tree_endpoint(async_client, fs, temp_project_dir):
     """Tests the file tree endpoint. Should now find index.html."""
+    fs.create_file(temp_project_dir / "index.html")
+
+    response = await async_client.get("/files/tree")
+    assert response.status_code == 200
+    assert response.json()["tree"] == ["index.html"]
+
+async def test_get_files_tree_etag(async_client, temp_project_dir):
+    """Tests that an unchanged tree answers 304 and a new file changes the ETag."""
+    # Stays on the real disk: pyfakefs doesn't bump a directory's mtime when entries are added
     (temp_project_dir / "index.html").touch()
-    
-    with patch('main.CLONED_PROJECT_DIR', str(temp_project_dir)):
-        response = client.get("/files/tree")
-        assert response.status_code == 200
-        assert response.json()["tree"] == ["index.html"]
 
-def test_get_file_content_endpoint(client, temp_project_dir):
+    response = await async_client.get("/files/tree")
+    etag = response.headers["ETag"]
+
+    response = await async_client.get("/files/tree", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    (temp_project_dir / "assets").mkdir()
+    (temp_project_dir / "assets" / "logo.png").touch()
+    response = await async_client.get("/files/tree", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.json()["tree"] == ["index.html", os.path.join("assets", "logo.png")]
+
+def test_list_project_files_skips_symlinked_dirs(app_state, tmp_path, temp_project_dir):
+    """Tests that, as with os.walk, a symlinked directory is neither listed nor descended into."""
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    (outside / "secret.txt").touch()
+    (temp_project_dir / "index.html").touch()
+    (temp_project_dir / "link").symlink_to(outside, target_is_directory=True)
+    (temp_project_dir / "alias.html").symlink_to(temp_project_dir / "index.html")
+
+    files, _ = app_state.list_project_files()
+    assert sorted(files) == ["alias.html", "index.html"]
+
+def test_list_project_files_expires_without_mtime_change(app_state, monkeypatch, fs, temp_project_dir):
+    """Tests that a file added without bumping directory mtimes shows up once the listing expires."""
+    # pyfakefs leaves directory mtimes alone on create, like a coarse-timestamp filesystem
+    fs.create_file(temp_project_dir / "index.html")
+    files, etag = app_state.list_project_files()
+    fs.create_file(temp_project_dir / "late.css")
+    assert app_state.list_project_files() == (files, etag) # still within the TTL
+
+    monkeypatch.setattr('backend.main.FILES_TREE_CACHE_TTL', 0)
+    files, new_etag = app_state.list_project_files()
+    assert sorted(files) == ["index.html", "late.css"]
+    assert new_etag != etag
+
+async def test_get_file_content_endpoint(async_client, fs, temp_project_dir):
     """Tests the file content endpoint."""
-    file_path = temp_project_dir / "index.html"
-    file_path.write_text("<h1>Hello</h1>")
+    fs.create_file(temp_project_dir / "index.html", contents="<h1>Hello</h1>")
 
-    with patch('main.CLONED_PROJECT_DIR', str(temp_project_dir)):
-        response = client.get("/files/content?path=index.html")
-        assert response.status_code == 200
-        assert response.json()["content"] == "<h1>Hello</h1>"
+    response = await async_client.get("/files/content?path=index.html")
+    assert response.status_code == 200
+    assert response.json()["content"] == "<h1>Hello</h1>"
 
-def test_get_file_content_not_found(client, temp_project_dir):
+async def test_get_file_content_not_found(async_client):
     """Tests that the file content endpoint returns 404 for a missing file."""
-    with patch('main.CLONED_PROJECT_DIR', str(temp_project_dir)):
-        response = client.get("/files/content?path=nonexistent.txt")
-        assert response.status_code == 404
+    response = await async_client.get("/files/content?path=nonexistent.txt")
+    assert response.status_code == 404
 
-def test_websocket_clone_endpoint():
+def test_websocket_clone_endpoint(client, mocker):
     """Tests that the WebSocket endpoint successfully creates and runs the clone task."""
-    client = TestClient(app)
     # Mock the main clone_website method to prevent it from actually running
-    with patch('main.AppState.clone_website', new_callable=AsyncMock) as mock_clone:
-        with client.websocket_connect("/ws/clone") as websocket:
-            websocket.send_json({"url": "https://example.com"})
-            # The test will complete because the mocked clone_website returns immediately.
-    
+    mock_clone = mocker.patch('backend.main.AppState.clone_website', new_callable=AsyncMock)
+    with client.websocket_connect("/ws/clone") as websocket:
+        websocket.send_json({"url": "https://example.com"})
+        # The test will complete because the mocked clone_website returns immediately.
+
     # Assert that clone_website was called once with the correct URL.
     mock_clone.assert_called_once()
-    assert str(mock_clone.call_args[0][0]) == "https://example.com/" 
\ No newline at end of file
+    assert str(mock_clone.call_args[0][0]) == "https://example.com/" 
+
+def test_stream_clone_endpoint(client):
+    """Tests that the SSE endpoint runs the clone and streams its events."""
+    async def fake_clone(self, url, notif):
+        await notif.log("hello")
+        await notif.ai_token("<html>")
+
+    with patch('backend.main.AppState.clone_website', new=fake_clone):
+        response = client.get("/stream/clone?url=https://example.com")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert 'event: log\ndata: {"message":"hello"}\n\n' in response.text
+    assert 'event: ai_tokens\ndata: {"tokens":["<html>"]}\n\n' in response.text
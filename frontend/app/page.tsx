@@ -81,8 +81,8 @@ export default function AIWebsiteBuilder() {
           setAiResponse("")
         }
         setMessages((prev) => [...prev, { id: Date.now().toString(), role: "assistant", content: data.message }])
-      } else if (eventType === "ai_token") {
-        setAiResponse((prev) => prev + data.token)
+      } else if (eventType === "ai_tokens") {
+        setAiResponse((prev) => prev + data.tokens.join(""))
       } else if (eventType === "file_create" || eventType === "file_update") {
         setFiles((prev) => {
           const newFiles = new Map(prev)